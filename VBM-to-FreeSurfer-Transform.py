@@ -3,6 +3,7 @@ import argparse
 import logging
 import pandas as pd
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 def setup_logging(log_path):
     """Sets up logging to both console and file."""
@@ -23,63 +24,99 @@ def load_subjects(csv_path):
     return pd.read_csv(csv_path, header=None)[0]
 
 def find_matching_subjects(mwp1_subjects, freesurfer_subjects):
-    """Finds matching and unmatched subjects."""
-    matching = mwp1_subjects[mwp1_subjects.isin(freesurfer_subjects)]
-    unmatched = freesurfer_subjects[~freesurfer_subjects.isin(mwp1_subjects)]
+    """Finds unique matching subjects and unmatched subjects."""
+    mwp1_set = set(mwp1_subjects.dropna().tolist())
+    freesurfer_set = set(freesurfer_subjects.dropna().tolist())
+    matching = list(dict.fromkeys(subj for subj in mwp1_subjects.tolist() if subj in freesurfer_set))
+    unmatched = [subj for subj in freesurfer_subjects.tolist() if subj not in mwp1_set]
     return matching, unmatched
 
 def write_unmatched_subjects(unmatched, output_log_path):
     """Writes unmatched subjects to a log file."""
     with open(output_log_path, "w") as log_file:
         log_file.write("Unmatched FreeSurfer IDs:\n")
-        log_file.writelines(f"{subj}\n" for subj in unmatched.tolist())
+        log_file.writelines(f"{subj}\n" for subj in unmatched)
 
-def process_subjects(matching_subjects, freesurfer_subjects, data_dir, output_dir, subjects_dir, freesurfer_home):
-    """Processes each subject and transforms brain images from VBM space to FreeSurfer space."""
+def format_command_output(*streams):
+    """Joins captured command output streams, skipping empty ones."""
+    return "\n".join(stream.rstrip() for stream in streams if stream and stream.strip())
+
+def run_freesurfer_command(command, mwp1_file):
+    """Runs a FreeSurfer command and logs its captured output under the subject's file name."""
+    tool = os.path.basename(command[0])
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"{tool} failed for {mwp1_file}: {e}\n{format_command_output(e.stdout, e.stderr)}")
+        return False
+
+    output = format_command_output(result.stdout, result.stderr)
+    if output:
+        logging.info(f"{tool} output for {mwp1_file}:\n{output}")
+    return True
+
+def process_subject(subject_id, data_dir, output_dir, subjects_dir, freesurfer_home):
+    """Transforms a single subject's brain image from VBM space to FreeSurfer space."""
+    mwp1_file = f"mwp1{subject_id}_T1w.nii"
+    freesurfer_id = subject_id
+    logging.info(f"Processing {mwp1_file} with FreeSurfer ID {freesurfer_id}")
+
+    cat12_gm = os.path.join(data_dir, mwp1_file)
+    reg_output = os.path.join(output_dir, f"{mwp1_file}_register.dat")
+    output_image = os.path.join(output_dir, f"{mwp1_file}_output.mgz")
+    brain_mgz = os.path.join(subjects_dir, freesurfer_id, "mri", "brain.mgz")
+
+    if not os.path.exists(cat12_gm):
+        logging.warning(f"File not found {cat12_gm}. Skipping...")
+        return
+
+    if not os.path.exists(os.path.join(subjects_dir, freesurfer_id)):
+        logging.warning(f"FreeSurfer directory not found for {freesurfer_id}. Skipping...")
+        return
+
+    bbregister_command = [
+        f"{freesurfer_home}/bin/bbregister", "--s", freesurfer_id,
+        "--mov", cat12_gm, "--reg", reg_output, "--t1"
+    ]
+    if not run_freesurfer_command(bbregister_command, mwp1_file):
+        return
+
+    mri_vol2vol_command = [
+        f"{freesurfer_home}/bin/mri_vol2vol", "--mov", cat12_gm,
+        "--targ", brain_mgz, "--reg", reg_output, "--o", output_image,
+        "--interp", "trilin", "--no-save-reg"
+    ]
+    if not run_freesurfer_command(mri_vol2vol_command, mwp1_file):
+        return
+
+    logging.info(f"Transformation completed for {mwp1_file}")
+
+def process_subjects(matching_subjects, data_dir, output_dir, subjects_dir, freesurfer_home, n_jobs=None):
+    """Processes subjects in parallel and transforms brain images from VBM space to FreeSurfer space."""
     os.environ["FREESURFER_HOME"] = freesurfer_home
     os.environ["SUBJECTS_DIR"] = subjects_dir
     os.environ["PATH"] = f"{freesurfer_home}/bin:" + os.environ["PATH"]
-    
-    for subject_id in matching_subjects:
-        mwp1_file = f"mwp1{subject_id}_T1w.nii"
-        freesurfer_id = freesurfer_subjects[freesurfer_subjects == subject_id].iloc[0]
-        logging.info(f"Processing {mwp1_file} with FreeSurfer ID {freesurfer_id}")
-
-        cat12_gm = os.path.join(data_dir, mwp1_file)
-        reg_output = os.path.join(output_dir, f"{mwp1_file}_register.dat")
-        output_image = os.path.join(output_dir, f"{mwp1_file}_output.mgz")
-        brain_mgz = os.path.join(subjects_dir, freesurfer_id, "mri", "brain.mgz")
-
-        if not os.path.exists(cat12_gm):
-            logging.warning(f"File not found {cat12_gm}. Skipping...")
-            continue
-        
-        if not os.path.exists(os.path.join(subjects_dir, freesurfer_id)):
-            logging.warning(f"FreeSurfer directory not found for {freesurfer_id}. Skipping...")
-            continue
-
-        bbregister_command = [
-            f"{freesurfer_home}/bin/bbregister", "--s", freesurfer_id,
-            "--mov", cat12_gm, "--reg", reg_output, "--t1"
-        ]
-        try:
-            subprocess.run(bbregister_command, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"bbregister failed for {mwp1_file}: {e}")
-            continue
-
-        mri_vol2vol_command = [
-            f"{freesurfer_home}/bin/mri_vol2vol", "--mov", cat12_gm,
-            "--targ", brain_mgz, "--reg", reg_output, "--o", output_image,
-            "--interp", "trilin", "--no-save-reg"
+
+    # Subjects only wait on external FreeSurfer processes, so threads are enough to fan out;
+    # bbregister is single-threaded but memory hungry, so default to a quarter of the cores.
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = max(1, (os.cpu_count() or 1) // 4)
+
+    # Repeated IDs would race on the same register and output files, so submit each once.
+    unique_subjects = dict.fromkeys(matching_subjects)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(process_subject, subject_id, data_dir, output_dir,
+                            subjects_dir, freesurfer_home)
+            for subject_id in unique_subjects
         ]
         try:
-            subprocess.run(mri_vol2vol_command, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"mri_vol2vol failed for {mwp1_file}: {e}")
-            continue
-        
-        logging.info(f"Transformation completed for {mwp1_file}")
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Don't start queued subjects after Ctrl-C or an unexpected worker error.
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
 def main():
     parser = argparse.ArgumentParser(description="Transform brain images from VBM space to FreeSurfer space.")
@@ -90,6 +127,7 @@ def main():
     parser.add_argument("--subjects_dir", required=True, help="Path to FreeSurfer subjects directory")
     parser.add_argument("--freesurfer_home", required=True, help="Path to FreeSurfer installation")
     parser.add_argument("--log_path", default="processing.log", help="Path to log file")
+    parser.add_argument("--n_jobs", type=int, default=None, help="Number of subjects to process in parallel (default: CPU count / 4; values < 1 use the default)")
     
     args = parser.parse_args()
     
@@ -105,7 +143,7 @@ def main():
     matching_subjects, unmatched_subjects = find_matching_subjects(mwp1_subjects, freesurfer_subjects)
     logging.info(f"Number of unmatched FreeSurfer IDs: {len(unmatched_subjects)}")
     write_unmatched_subjects(unmatched_subjects, args.log_path)
-    process_subjects(matching_subjects, freesurfer_subjects, args.data_dir, args.output_dir, args.subjects_dir, args.freesurfer_home)
+    process_subjects(matching_subjects, args.data_dir, args.output_dir, args.subjects_dir, args.freesurfer_home, args.n_jobs)
     logging.info("Batch processing complete.")
 
 if __name__ == "__main__":